@@ -1,223 +1,656 @@
 import streamlit as st
 import pandas as pd
-from docx import Document
+import html
 import io
-from difflib import SequenceMatcher
+import math
+import os
+import posixpath
+import zipfile
+from collections import Counter
+from bisect import bisect_left
+from difflib import Match, SequenceMatcher
+from functools import lru_cache
 import re
+from lxml import etree
 
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional; fall back to per-row substring scans
+    ahocorasick = None
+
+try:
+    from rapidfuzz import fuzz
+    from rapidfuzz.distance import Indel
+    from rapidfuzz.process import extractOne
+except ImportError:  # rapidfuzz is optional; fall back to difflib
+    fuzz = None
+    Indel = None
+    extractOne = None
+
+try:
+    from rapidfuzz.process import cpdist
+except ImportError:  # cpdist needs rapidfuzz 3.6+; without it pairs are screened one by one
+    cpdist = None
+
+try:
+    import diff_match_patch as dmp_module
+    _dmp = dmp_module.diff_match_patch()
+    _dmp.Diff_Timeout = 0.5
+except ImportError:  # diff-match-patch is optional; long inputs use the default diff
+    _dmp = None
+
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:  # python-calamine is optional; fall back to openpyxl
+    EXCEL_ENGINE = "openpyxl"
+
+# Positions of the Excel columns the checker reads (D: sentence, F: location)
+SENTENCE_COLUMN = 3
+LOCATION_COLUMN = 5
+
+# Package relationships that point at the main document part, as python-docx resolves it
+_PACKAGE_RELS = "_rels/.rels"
+_RELATIONSHIP = "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"
+_OFFICE_DOCUMENT_REL_TYPE = "/officeDocument"
+# Where Word puts the main part; used when the package relationships do not name one
+_DEFAULT_DOCUMENT_PART = "word/document.xml"
+
+# WordprocessingML element names used when reading the main document part directly
+_W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_W_BODY = f"{{{_W_NS}}}body"
+_W_P = f"{{{_W_NS}}}p"
+_W_BR = f"{{{_W_NS}}}br"
+# Run children that python-docx renders as fixed characters in Paragraph.text
+_W_RUN_CHARS = {
+    f"{{{_W_NS}}}tab": "\t",
+    f"{{{_W_NS}}}ptab": "\t",
+    f"{{{_W_NS}}}cr": "\n",
+    f"{{{_W_NS}}}noBreakHyphen": "-",
+    _W_BR: "\n",
+}
+# Text and character elements of a paragraph's runs, in document order.
+# Page and column breaks do not produce text.
+_RUN_CONTENT = etree.XPath(
+    "(w:r | w:hyperlink/w:r)/w:t/text()"
+    " | (w:r | w:hyperlink/w:r)/*[self::w:tab or self::w:ptab or self::w:cr or self::w:noBreakHyphen]"
+    " | (w:r | w:hyperlink/w:r)/w:br[not(@w:type) or @w:type = 'textWrapping']",
+    namespaces={"w": _W_NS},
+    smart_strings=False,
+)
+
+# Markup wrapped around the parts of a sentence that differ from the document;
+# the class is styled once per page by _HIGHLIGHT_STYLE
+_HIGHLIGHT_OPEN = '<span class="qa-diff">'
+_HIGHLIGHT_CLOSE = '</span>'
+_HIGHLIGHT_STYLE = "<style>.qa-diff { background-color: #fdd835; }</style>"
+# Below this share of matchable characters the whole sentence is highlighted without diffing
+MIN_SHARED_CHAR_RATIO = 0.3
+# With at least this many tokens (words and whitespace runs) on both sides combined,
+# diffs are computed per token
+TOKEN_DIFF_MIN_TOKENS = 80
+# Words and the whitespace between them, so joined tokens reproduce the original text
+_TOKEN_RE = re.compile(r"\S+|\s+")
+# Above this length, diffs go through diff-match-patch instead of matching blocks
+DMP_LENGTH_THRESHOLD = 2000
+# Number of result rows rendered per page in the UI
+RESULTS_PER_PAGE = 50
+# From this many pairs on, the shared-character screen runs as one batched cpdist call
+BATCH_SCREEN_THRESHOLD = 32
+
+
+class _WindowedSequenceMatcher(SequenceMatcher):
+    """
+    SequenceMatcher whose find_longest_match slices each element's b2j positions to the
+    current b window once, instead of range-checking every position on every occurrence
+    (the approach of CPython gh-106877). Only valid without junk: no isjunk, autojunk=False.
+    """
+
+    def find_longest_match(self, alo=0, ahi=None, blo=0, bhi=None):
+        a, b2j = self.a, self.b2j
+        if ahi is None:
+            ahi = len(a)
+        if bhi is None:
+            bhi = len(self.b)
+        besti, bestj, bestsize = alo, blo, 0
+        # b2j position lists are ascending, so the in-window part is one bisected slice
+        in_window = {}
+        j2len = {}
+        for i in range(alo, ahi):
+            elt = a[i]
+            positions = in_window.get(elt)
+            if positions is None:
+                positions = b2j.get(elt, ())
+                positions = in_window[elt] = positions[bisect_left(positions, blo):bisect_left(positions, bhi)]
+            j2lenget = j2len.get
+            newj2len = {}
+            for j in positions:
+                k = newj2len[j] = j2lenget(j - 1, 0) + 1
+                if k > bestsize:
+                    besti, bestj, bestsize = i - k + 1, j - k + 1, k
+            j2len = newj2len
+        # Without junk elements the longest match cannot be extended further
+        return Match(besti, bestj, bestsize)
+
+
+def _unmatched_ranges(a, b):
+    """
+    Returns (is_unmatched, j1, j2) ranges covering sequence b in order, where the unmatched
+    ranges are the parts of b outside the blocks it shares with sequence a.
+    Works on strings (characters) as well as lists of tokens.
+    """
+    if Indel is not None:
+        # rapidfuzz computes the matching blocks in C
+        blocks = Indel.editops(a, b).as_matching_blocks()
+    else:
+        # Walking the matching blocks skips difflib's opcode tagging loop
+        blocks = _WindowedSequenceMatcher(None, a, b, autojunk=False).get_matching_blocks()
+    ranges = []
+    append = ranges.append
+    b_pos = 0
+    # The last block is the (len(a), len(b), 0) sentinel, so the tail of b is covered too
+    for _, j, size in blocks:
+        append((True, b_pos, j))
+        append((False, j, j + size))
+        b_pos = j + size
+    return ranges
+
+
+def _render_highlights(segments):
+    """
+    Joins (is_highlighted, fragment) pairs into one HTML string, wrapping highlighted
+    fragments in a yellow span. Fragments are HTML-escaped since they come from user files.
+    Consecutive highlighted fragments share a single span.
+    """
+    escape = html.escape
+    parts = []
+    append = parts.append
+    in_span = False
+    for highlighted, fragment in segments:
+        if not fragment:
+            continue
+        if highlighted != in_span:
+            append(_HIGHLIGHT_OPEN if highlighted else _HIGHLIGHT_CLOSE)
+            in_span = highlighted
+        append(escape(fragment))
+    if in_span:
+        append(_HIGHLIGHT_CLOSE)
+    return "".join(parts)
+
+
+def _shared_char_ratio(text1, text2, indel_distance=None):
+    """
+    Returns the share of text1's characters that a diff against text2 could leave
+    unhighlighted, without computing the diff itself.
+    An Indel distance already computed for the pair can be passed in.
+    """
+    if not text1:
+        return 1.0
+    if indel_distance is None and len(text2) < MIN_SHARED_CHAR_RATIO * len(text1):
+        # Like difflib's real_quick_ratio: at most len(text2) characters can match, no scan needed
+        return len(text2) / len(text1)
+    if indel_distance is None and Indel is not None:
+        indel_distance = Indel.distance(text1, text2)
+    if indel_distance is not None:
+        # Exact longest common subsequence length, from the bit-parallel Indel distance
+        shared = (len(text1) + len(text2) - indel_distance) // 2
+    else:
+        # The character multiset overlap is a linear-time upper bound on it
+        shared = sum((Counter(text1) & Counter(text2)).values())
+    return shared / len(text1)
+
+
+@lru_cache(maxsize=4096)
 def get_highlighted_diff(text1, text2):
     """
     Compares two strings and returns an HTML string with the parts of text1 
     that are not in text2 highlighted in yellow.
+    Longer inputs are compared word by word; short ones character by character.
     """
-    matcher = SequenceMatcher(None, text2, text1, autojunk=False)
-    
-    opcodes = matcher.get_opcodes()
-    
-    highlighted_text = []
-    for tag, i1, i2, j1, j2 in opcodes:
-        if tag == 'equal':
-            highlighted_text.append(text1[j1:j2])
-        elif tag == 'insert':
-            highlighted_text.append(f'<span style="background-color: #fdd835;">{text1[j1:j2]}</span>')
-        elif tag == 'replace':
-            highlighted_text.append(f'<span style="background-color: #fdd835;">{text1[j1:j2]}</span>')
-        
-    return "".join(highlighted_text)
+    if _shared_char_ratio(text1, text2) < MIN_SHARED_CHAR_RATIO:
+        # Too little in common for a diff to be meaningful; flag the whole text
+        return _render_highlights([(True, text1)])
+    return _diff_to_html(text1, text2)
+
 
+def _diff_to_html(text1, text2):
+    """
+    Runs the actual diff for get_highlighted_diff, once the pair is known to be worth diffing.
+    """
+    if text1 == text2:
+        return _render_highlights([(False, text1)])
 
+    tokens1 = _TOKEN_RE.findall(text1)
+    tokens2 = _TOKEN_RE.findall(text2)
+    if len(tokens1) + len(tokens2) >= TOKEN_DIFF_MIN_TOKENS:
+        segments = [
+            (unmatched, "".join(tokens1[j1:j2]))
+            for unmatched, j1, j2 in _unmatched_ranges(tokens2, tokens1)
+        ]
+        return _render_highlights(segments)
+
+    if _dmp is not None and max(len(text1), len(text2)) > DMP_LENGTH_THRESHOLD:
+        diffs = _dmp.diff_main(text2, text1)
+        _dmp.diff_cleanupSemantic(diffs)
+        # Deleted fragments only exist in text2, so they are left out
+        segments = [(op == _dmp.DIFF_INSERT, fragment) for op, fragment in diffs if op != _dmp.DIFF_DELETE]
+        return _render_highlights(segments)
+
+    # Near-identical pairs only differ in the middle; strip the common ends so the
+    # diff only runs on the differing cores
+    prefix_len = len(os.path.commonprefix([text1, text2]))
+    core1 = text1[prefix_len:]
+    core2 = text2[prefix_len:]
+    suffix_len = len(os.path.commonprefix([core1[::-1], core2[::-1]]))
+    if suffix_len:
+        core1 = core1[:-suffix_len]
+        core2 = core2[:-suffix_len]
+
+    # Unmatched ranges are the text1 content that is missing from text2
+    segments = [(False, text1[:prefix_len])]
+    segments.extend(
+        (unmatched, core1[j1:j2])
+        for unmatched, j1, j2 in _unmatched_ranges(core2, core1)
+    )
+    segments.append((False, text1[len(text1) - suffix_len:]))
+    return _render_highlights(segments)
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def compute_highlights(results):
+    """
+    Computes the highlighted diff for every result that carries compared document text.
+    Returns a dictionary mapping (sentence, doc_text) to the highlight HTML.
+    With many pairs, all of them are screened in one batched rapidfuzz call first, so
+    only the pairs worth diffing reach the diff itself.
+    """
+    pairs = list(dict.fromkeys((res["sentence"], res["doc_text"]) for res in results if res.get("doc_text")))
+    if cpdist is None or len(pairs) < BATCH_SCREEN_THRESHOLD:
+        return {pair: get_highlighted_diff(*pair) for pair in pairs}
+
+    # Indel distances for every pair at once, multi-threaded with the GIL released
+    distances = cpdist(
+        [sentence for sentence, _ in pairs],
+        [doc_text for _, doc_text in pairs],
+        scorer=Indel.distance,
+        workers=-1,
+    )
+    highlights = {}
+    for pair, distance in zip(pairs, distances.tolist()):
+        if _shared_char_ratio(*pair, indel_distance=distance) < MIN_SHARED_CHAR_RATIO:
+            highlights[pair] = _render_highlights([(True, pair[0])])
+        else:
+            highlights[pair] = _diff_to_html(*pair)
+    return highlights
+
+
+def _paragraph_text(p):
+    """
+    Returns the text of a <w:p> element the same way python-docx's Paragraph.text does:
+    runs and hyperlinked runs, with tabs as '\t' and line breaks as '\n'.
+    """
+    # The compiled XPath walks the runs inside libxml2 and yields text nodes and
+    # character elements in document order, so only the join happens in Python
+    return "".join(
+        part if part.__class__ is str else _W_RUN_CHARS[part.tag]
+        for part in _RUN_CONTENT(p)
+    )
+
+
+def get_trigrams(text):
+    """
+    Returns the set of all 3-character substrings of text.
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _main_document_part(docx_zip):
+    """
+    Returns the zip member name of the main document part, read from the officeDocument
+    relationship in _rels/.rels. Falls back to word/document.xml if there is none.
+    """
+    try:
+        rels = etree.fromstring(docx_zip.read(_PACKAGE_RELS), etree.XMLParser(resolve_entities=False))
+    except KeyError:
+        return _DEFAULT_DOCUMENT_PART
+    for rel in rels.iter(_RELATIONSHIP):
+        if rel.get("Type", "").endswith(_OFFICE_DOCUMENT_REL_TYPE) and rel.get("TargetMode") != "External":
+            # Targets in the package-level relationships are relative to the package root
+            return posixpath.normpath(rel.get("Target", "").lstrip("/"))
+    return _DEFAULT_DOCUMENT_PART
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
 def parse_docx(file_content):
     """
     Parses the uploaded .docx file content, numbering ALL paragraphs sequentially.
-    Returns two dictionaries:
-    - doc_data: maps 'Ln:Tn' to the paragraph text.
-    - line_to_key_map: maps a line number (int) to its full key 'Ln:Tn'.
+    Reads the main document part (normally word/document.xml) with lxml instead of
+    building python-docx's object model.
+    Returns two lists, indexed by line number - 1:
+    - doc_texts_by_line: the stripped text of each paragraph.
+    - trigrams_by_line: the set of trigrams in each paragraph's text.
     """
-    doc_data = {}
-    line_to_key_map = {}
-    doc = Document(io.BytesIO(file_content))
+    doc_texts_by_line = []
+    trigrams_by_line = []
+    # Bind the per-paragraph callables to locals once for the loop below
+    paragraph_text = _paragraph_text
+    trigrams_of = get_trigrams
+    add_text = doc_texts_by_line.append
+    add_trigrams = trigrams_by_line.append
+    # Repeated paragraphs (headers, agenda labels, empty lines) share one text object
+    # and one trigram set, so their hashing and trigram extraction happen only once
+    paragraph_pool = {}
     
-    # Initialize a counter that increments for *every* paragraph, regardless of content
-    true_line_number_counter = 0 
-    
-    for para in doc.paragraphs:
-        true_line_number_counter += 1 # Increment for every paragraph encountered
-        
-        tab_count = para.text.count('\t')
-        clean_text = para.text.strip() # Still strip whitespace for comparison later
-        
-        # The key uses the 'true_line_number_counter' for 'L'
-        key = f"L{true_line_number_counter}:T{tab_count}"
-        
-        # Store the cleaned text. If it was an empty paragraph, clean_text will be empty.
-        doc_data[key] = clean_text
+    with zipfile.ZipFile(io.BytesIO(file_content)) as docx_zip, docx_zip.open(_main_document_part(docx_zip)) as xml_stream:
+        # Stream the XML so only the paragraph being read is held in memory
+        for _, p in etree.iterparse(xml_stream, events=("end",), tag=_W_P, resolve_entities=False):
+            # Only top-level body paragraphs are numbered, matching python-docx's Document.paragraphs;
+            # paragraphs inside tables or text boxes are skipped.
+            # Every other paragraph gets the next line number, regardless of content.
+            if p.getparent().tag != _W_BODY:
+                continue
+            
+            clean_text = paragraph_text(p).strip() # Still strip whitespace for comparison later
+            pooled = paragraph_pool.get(clean_text)
+            if pooled is None:
+                # Index the paragraph's trigrams once so failing rows can find their closest line
+                pooled = paragraph_pool[clean_text] = (clean_text, trigrams_of(clean_text))
         
-        # Map this true line number to its key
-        line_to_key_map[true_line_number_counter] = key
+            # Store the cleaned text. If it was an empty paragraph, clean_text will be empty.
+            add_text(pooled[0])
+            add_trigrams(pooled[1])
+            
+            # Free the finished paragraph and everything before it in the body
+            p.clear()
+            while p.getprevious() is not None:
+                del p.getparent()[0]
         
-    return doc_data, line_to_key_map
+    return doc_texts_by_line, trigrams_by_line
 
-def parse_location_string(location_str, line_to_key_map):
+def _location_line(location):
     """
-    Parses a location string (e.g., "L21:C", "L21:T0 - L24:T3") and returns a list of valid doc_data keys.
-    Uses line_to_key_map to find the actual key for a given line number.
+    Returns the line number of a single location like "L21:T0" or "L24:C", or None if it
+    does not start with L<digits>:T or L<digits>:C. Anything after the T/C is ignored.
+    """
+    head, _, tail = location.partition(":")
+    digits = head[1:]
+    # isdecimal accepts exactly the characters a \d regex would
+    if head[:1] != "L" or not digits.isdecimal() or tail[:1] not in ("T", "C"):
+        return None
+    return int(digits)
+
+
+def parse_location_string(location_str, line_count):
+    """
+    Parses a location string (e.g., "L21:C", "L21:T0 - L24:T3") and returns the (first, last)
+    line numbers it covers, clamped to the line_count lines of the document.
+    Returns None if the format is invalid or no line of the document is covered.
     """
     location_str = location_str.strip()
     
-    # Regex to capture the line number from formats like L21:T0, L24:C, etc.
-    range_regex = r"L(\d+):[TC]\d*" 
-    
     # Handle ranges
     if " - " in location_str:
         try:
             start_loc, end_loc = location_str.split(" - ")
-            start_match = re.match(range_regex, start_loc.strip())
-            end_match = re.match(range_regex, end_loc.strip())
-
-            if not start_match or not end_match:
-                return [] 
-
-            start_l = int(start_match.group(1))
-            end_l = int(end_match.group(1))
-            
-            keys = []
-            for line_num in range(start_l, end_l + 1):
-                key = line_to_key_map.get(line_num)
-                if key: # Only add if a corresponding key exists (i.e., that line number was parsed)
-                    keys.append(key)
-            return keys
-        except Exception:
-             return []
+        except ValueError:
+            return None
+        start_l = _location_line(start_loc.strip())
+        end_l = _location_line(end_loc.strip())
     # Handle single location
     else:
-        try:
-            match = re.match(range_regex, location_str)
-            if not match:
-                return []
-            
-            line_num = int(match.group(1))
-            key = line_to_key_map.get(line_num)
-            return [key] if key else []
-        except Exception:
-            return []
+        start_l = end_l = _location_line(location_str)
+
+    if start_l is None or end_l is None:
+        return None
+
+    # Only keep line numbers that exist in the document (1 to line_count)
+    start_l = max(start_l, 1)
+    end_l = min(end_l, line_count)
+    if start_l > end_l:
+        return None
+    return start_l, end_l
+
+
+def find_sentence_matches(sentences, doc_texts_by_line):
+    """
+    Builds one Aho-Corasick automaton from all sentences and sweeps every paragraph once.
+    Returns a dictionary mapping each sentence to the set of line numbers whose text
+    contains it, or None if pyahocorasick is not installed.
+    """
+    if ahocorasick is None:
+        return None
+
+    matches = {}
+    if not sentences:
+        return matches
+
+    automaton = ahocorasick.Automaton()
+    for sentence in sentences:
+        automaton.add_word(sentence, sentence)
+    automaton.make_automaton()
+
+    # Paragraphs shorter than the shortest sentence cannot contain any of them
+    shortest_sentence_len = min(map(len, sentences))
+    for line_num, text in enumerate(doc_texts_by_line, start=1):
+        if len(text) < shortest_sentence_len:
+            continue
+        for _, sentence in automaton.iter(text):
+            matches.setdefault(sentence, set()).add(line_num)
+    return matches
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def load_excel(xlsx_content):
+    """
+    Reads the sentence and location columns of the uploaded .xlsx file content into a
+    two-column DataFrame, using the first row as the header.
+    Returns an empty DataFrame if the sheet does not have that many columns.
+    """
+    try:
+        return pd.read_excel(
+            io.BytesIO(xlsx_content),
+            header=0,
+            engine=EXCEL_ENGINE,
+            usecols=[SENTENCE_COLUMN, LOCATION_COLUMN],
+            # Both columns are compared as text; reading them as str skips numeric type inference
+            dtype=str,
+        )
+    except pd.errors.ParserError:
+        # pandas rejects usecols positions past the last column
+        return pd.DataFrame()
+
+
+def get_checked_lines(location_str, line_count):
+    """
+    Returns the (first, last) line numbers to search for a location string, or None if it is invalid.
+    Single locations are expanded to 5 lines before and 5 lines after; ranges are used as given.
+    """
+    span = parse_location_string(location_str, line_count)
+    if span is None:
+        return None
+
+    first_line, last_line = span
+    # If the original location was a single line, expand to include +/- 5 lines
+    if first_line == last_line:
+        # Ensure line number stays within the document
+        first_line = max(1, first_line - 5)
+        last_line = min(line_count, last_line + 5)
+    return first_line, last_line
+
+
+def find_closest_line(sentence, first_line, last_line, doc_texts_by_line, trigrams_by_line):
+    """
+    Finds the line from first_line to last_line that best matches the sentence.
+    Lines sharing no trigram with the sentence are ruled out; the rest are ranked by
+    rapidfuzz's ratio, or by the number of shared trigrams without rapidfuzz.
+    Returns the best line number, or None if no line shares a trigram with the sentence.
+    """
+    sentence_trigrams = get_trigrams(sentence)
+    trigram_scores = {}
+    for line_num in range(first_line, last_line + 1):
+        score = len(sentence_trigrams.intersection(trigrams_by_line[line_num - 1]))
+        if score:
+            trigram_scores[line_num] = score
+    if not trigram_scores:
+        return None
 
+    if extractOne is not None:
+        # Whole-string similarity is cheap enough to score every candidate, in C
+        _, _, closest_line = extractOne(
+            sentence,
+            {line_num: doc_texts_by_line[line_num - 1] for line_num in trigram_scores},
+            scorer=fuzz.ratio,
+        )
+        return closest_line
+    return max(trigram_scores, key=trigram_scores.get)
 
-def run_checker(df, doc_data, line_to_key_map):
+
+def run_checker(df, doc_texts_by_line, trigrams_by_line):
     """
-    Checks each row of the DataFrame against the parsed document data.
+    Checks each row of the DataFrame returned by load_excel against the parsed document data.
     Handles single locations by expanding the search to 5 lines before and 5 lines after.
     For ranges, checks within the specified range.
     Returns a list of dictionaries with the results.
     """
     results = []
     
-    if len(df.columns) < 6:
+    if len(df.columns) < 2:
         st.error("Error: The Excel file must have at least 6 columns.")
         return None
         
-    sentence_col_name = df.columns[3]
-    location_col_name = df.columns[5]
-    
-    for index, row in df.iterrows():
-        try:
-            sentence_to_check = str(row[sentence_col_name]).strip()
-            location_str = str(row[location_col_name]).strip()
-            
-            if not sentence_to_check or not location_str or sentence_to_check.lower() == 'nan' or location_str.lower() == 'nan':
-                continue
+    # load_excel only reads the sentence and location columns, in that order
+    sentence_col = df.iloc[:, 0]
+    location_col = df.iloc[:, 1]
 
-        except (KeyError, IndexError) as e:
-            st.error(f"Error accessing columns in Excel file. Details: {e}")
-            return None
+    sentences = sentence_col.astype(str).str.strip()
+    locations = location_col.astype(str).str.strip()
+    # Skip rows whose sentence or location is missing, blank or the text 'nan', for the whole column at once
+    keep = (
+        sentence_col.notna() & location_col.notna()
+        & sentences.ne('') & locations.ne('')
+        & sentences.str.lower().ne('nan') & locations.str.lower().ne('nan')
+    )
+    # Pull the surviving rows out as plain lists instead of boxing every row into a Series
+    excel_rows = (keep.to_numpy().nonzero()[0] + 2).tolist() # Excel row numbers (1-based, accounting for header)
+    sentences = sentences[keep].tolist()
+    locations = locations[keep].tolist()
+
+    # Find every sentence in every paragraph up front, in a single pass over the document
+    unique_sentences = set(sentences)
+    sentence_matches = find_sentence_matches(unique_sentences, doc_texts_by_line)
+
+    # The result is a pure function of (sentence, location), so repeated pairs are checked once
+    checked_pairs = {}
+
+    # Many rows cite the same location, so each distinct location string is resolved once per run
+    line_count = len(doc_texts_by_line)
+
+    @lru_cache(maxsize=None)
+    def resolve_location(location_str):
+        return get_checked_lines(location_str, line_count)
+
+    # Combined text of each (first_line, last_line) span used as diff context, built once per span
+    window_texts = {}
+    
+    for excel_row, sentence_to_check, location_str in zip(excel_rows, sentences, locations):
+        pair = (sentence_to_check, location_str)
+        if pair in checked_pairs:
+            result_item = dict(checked_pairs[pair])
+            result_item["excel_row"] = excel_row
+            results.append(result_item)
+            continue
 
         result_item = {
-            "excel_row": index + 2, # This shows the Excel row number (1-based, accounting for header)
+            "excel_row": excel_row,
             "location": location_str,
             "sentence": sentence_to_check,
             "status": "",
             "details": ""
         }
         
-        # Get the initially parsed location keys
-        initial_location_keys = parse_location_string(location_str, line_to_key_map)
-        
-        expanded_location_keys = []
-        if initial_location_keys:
-            # If the original location was a single line, expand to include +/- 5 lines
-            if len(initial_location_keys) == 1:
-                original_key = initial_location_keys[0]
-                # Extract the line number from the original_key (e.g., 'L65:T3' -> 65)
-                match = re.match(r"L(\d+):", original_key)
-                if match:
-                    original_line_num = int(match.group(1))
-                    
-                    # Determine the start and end line numbers for the expanded search
-                    # Ensure line number does not go below 1
-                    search_start_line = max(1, original_line_num - 5)
-                    search_end_line = original_line_num + 5
-                    
-                    # Collect all keys within this expanded range
-                    for line_num in range(search_start_line, search_end_line + 1):
-                        key = line_to_key_map.get(line_num)
-                        if key: # Add key only if it exists in the parsed document data
-                            expanded_location_keys.append(key)
-                else:
-                    # Fallback if original_key couldn't be parsed (shouldn't happen with valid input)
-                    expanded_location_keys = initial_location_keys
-            else:
-                # If it was already a range, just use the provided keys as is (no further expansion)
-                expanded_location_keys = initial_location_keys
-        
-        # --- End of NEW LOGIC ---
+        # Resolve the location, expanding single lines to the surrounding search window
+        checked_lines = resolve_location(location_str)
 
-        if not expanded_location_keys:
+        if checked_lines is None:
             result_item["status"] = "❌ Error"
             result_item["details"] = f"The specified location {location_str} could not be found or was in an invalid format. Please check line numbers and format (e.g., L21:T0, L24:C). Ensure the line number exists in the document."
         else:
-            # Use expanded_location_keys for text retrieval
-            doc_texts = [doc_data.get(key) for key in expanded_location_keys if doc_data.get(key) is not None]
+            first_line, last_line = checked_lines
+            # Paragraph texts are only gathered when a substring scan or the diff context needs them
+            doc_texts = None
             
             # Formulate the range that was actually checked for display in results
-            actual_checked_range = ""
-            if len(expanded_location_keys) > 1:
-                # Get the first and last line numbers from the sorted expanded keys
-                first_line_in_range = int(expanded_location_keys[0].split(':')[0][1:]) # Extract number from 'LXX:Tyy'
-                last_line_in_range = int(expanded_location_keys[-1].split(':')[0][1:])
-                actual_checked_range = f" (Checked range: L{first_line_in_range} - L{last_line_in_range})"
-            elif expanded_location_keys: # Should not be empty if we reach here, but defensive
-                actual_checked_range = f" (Checked line: {expanded_location_keys[0].split(':')[0]})"
-
-
-            is_found = False
-            for text in doc_texts:
-                if sentence_to_check in text:
-                    is_found = True
-                    break # Found a match, no need to check other lines in the range
+            if last_line > first_line:
+                actual_checked_range = f" (Checked range: L{first_line} - L{last_line})"
+            else:
+                actual_checked_range = f" (Checked line: L{first_line})"
+
+            if sentence_matches is not None:
+                # The automaton already reported every line containing the sentence
+                found_lines = sentence_matches.get(sentence_to_check, ())
+                is_found = any(first_line <= line_num <= last_line for line_num in found_lines)
+            else:
+                doc_texts = doc_texts_by_line[first_line - 1:last_line]
+                sentence_len = len(sentence_to_check)
+                # Stops at the first matching line; a paragraph shorter than the sentence cannot contain it
+                is_found = any(len(text) >= sentence_len and sentence_to_check in text for text in doc_texts)
 
             if is_found:
                 result_item["status"] = "✅ Correct"
                 result_item["details"] = f"The sentence was found exactly as stated in the document within the specified location {location_str}{actual_checked_range}."
             else:
-                # If not found, combine text for highlighting context
-                full_doc_text = " ".join(doc_texts)
+                if doc_texts is None:
+                    doc_texts = doc_texts_by_line[first_line - 1:last_line]
                 result_item["status"] = "❌ Incorrect"
-                # If the combined text is empty (e.g., trying to check an empty line)
-                if not full_doc_text.strip():
+                # If every line in the range is empty (paragraph texts are already stripped)
+                if not any(doc_texts):
                     result_item["details"] = f"The sentence was **not** found in the specified location {location_str}{actual_checked_range}. The document content at this location appears to be empty."
                 else:
-                    highlighted_diff = get_highlighted_diff(sentence_to_check, full_doc_text)
-                    result_item["details"] = f"The sentence was **not** found in any single line within the specified location {location_str}{actual_checked_range}. Differences compared to the combined text from the range are highlighted below:"
-                    result_item["highlighted"] = highlighted_diff
-                    result_item["doc_text"] = full_doc_text # Provide the combined text that was checked
+                    # Diff against the single closest line rather than the whole range
+                    closest_line = find_closest_line(sentence_to_check, first_line, last_line, doc_texts_by_line, trigrams_by_line)
+                    if closest_line is not None:
+                        result_item["details"] = f"The sentence was **not** found in any single line within the specified location {location_str}{actual_checked_range}. Differences compared to the closest matching line (L{closest_line}) are highlighted below:"
+                        result_item["doc_text"] = doc_texts_by_line[closest_line - 1]
+                    else:
+                        result_item["details"] = f"The sentence was **not** found in any single line within the specified location {location_str}{actual_checked_range}. Differences compared to the combined text from the range are highlighted below:"
+                        # Only now combine the segments, as the context for highlighting
+                        window_text = window_texts.get(checked_lines)
+                        if window_text is None:
+                            window_text = window_texts[checked_lines] = " ".join(doc_texts)
+                        result_item["doc_text"] = window_text # Provide the combined text that was checked
+                    # The highlight itself is computed only when the row is rendered
 
+        checked_pairs[pair] = result_item
         results.append(result_item)
         
     return results
 
 
+@st.cache_data(show_spinner=False, max_entries=8)
+def check_uploads(docx_content, xlsx_content):
+    """
+    Parses both uploads and runs the checker. Cached on the raw file bytes so that
+    Streamlit reruns (e.g. opening an expander) reuse the whole result list.
+    """
+    doc_texts_by_line, trigrams_by_line = parse_docx(docx_content)
+    df = load_excel(xlsx_content)
+    return run_checker(df, doc_texts_by_line, trigrams_by_line)
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def results_to_csv(results):
+    """
+    Returns the full result list as CSV bytes for download. The BOM lets Excel
+    open the Thai text with the right encoding.
+    """
+    columns = ["excel_row", "location", "sentence", "status", "details", "doc_text"]
+    return pd.DataFrame(results, columns=columns).to_csv(index=False).encode("utf-8-sig")
+
+
 # --- Streamlit App UI ---
 
 st.set_page_config(layout="wide")
+st.markdown(_HIGHLIGHT_STYLE, unsafe_allow_html=True)
 st.title("📄 Extractive Sentence Checker Tool")
 
 st.info("""
@@ -246,27 +679,40 @@ if docx_file is not None and xlsx_file is not None:
     st.header("Results")
 
     try:
-        docx_content = docx_file.getvalue()
-        doc_data, line_to_key_map = parse_docx(docx_content)
-        
-        df = pd.read_excel(xlsx_file, header=0) 
-
-        results = run_checker(df, doc_data, line_to_key_map)
+        results = check_uploads(docx_file.getvalue(), xlsx_file.getvalue())
 
         if results:
-            for res in results:
+            # Only the current page of results is rendered and diffed
+            page_count = math.ceil(len(results) / RESULTS_PER_PAGE)
+            page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1)
+            page_start = (page - 1) * RESULTS_PER_PAGE
+            page_results = results[page_start:page_start + RESULTS_PER_PAGE]
+            st.caption(f"Showing results {page_start + 1}-{page_start + len(page_results)} of {len(results)} (page {page} of {page_count})")
+
+            st.download_button(
+                "Download all results (CSV)",
+                data=results_to_csv(results),
+                file_name="qa_check_results.csv",
+                mime="text/csv",
+            )
+
+            highlights = compute_highlights(page_results)
+            for res in page_results:
                 with st.expander(f"**Row {res['excel_row']} | Location: {res['location']} | Status: {res['status']}**"):
-                    st.markdown(f"**Sentence to Check:**")
-                    st.markdown(f"> {res['sentence']}")
-                    st.markdown(f"**Details:** {res['details']}")
-                    
-                    if res.get("highlighted"):
-                        st.markdown("**Highlighted Differences:**")
-                        st.markdown(res["highlighted"], unsafe_allow_html=True)
-                        st.markdown("**Original Text from Document (from range checked):**")
-                        st.markdown(f"> {res['doc_text']}")
+                    # One markdown element per row; user text is escaped since the body allows HTML
+                    body = [
+                        "**Sentence to Check:**",
+                        f"> {html.escape(res['sentence'])}",
+                        f"**Details:** {html.escape(res['details'])}",
+                    ]
+                    if res.get("doc_text"):
+                        body.append("**Highlighted Differences:**")
+                        body.append(highlights[(res["sentence"], res["doc_text"])])
+                        body.append("**Original Text from Document (compared text):**")
+                        body.append(f"> {html.escape(res['doc_text'])}")
                     elif res.get("doc_text") == "": # Specific case for empty line in document
-                         st.markdown("**Original Text from Document (from range checked):** (Content at this location appears to be empty or contains only whitespace.)")
+                        body.append("**Original Text from Document (from range checked):** (Content at this location appears to be empty or contains only whitespace.)")
+                    st.markdown("\n\n".join(body), unsafe_allow_html=True)
 
 
     except Exception as e: